@@ -16,6 +16,7 @@ Key Features:
 Inputs needeed:
 - COCO JSON file (`_annotations.coco.json`) in the specified COCO folder + associated images.
 - ARK database CSV file (`arks_database.csv`) with titles and ARK identifiers.
+- Optional: the orjson package speeds up the loading of large COCO JSON files (pip install orjson).
 
 Parameters:
 - The path to the COCO folder must be provided as a command-line argument
@@ -23,6 +24,8 @@ Parameters:
 # If the image was downloaded using the IIIF Image API, this is the pct:n parameter; for example, 0.7 for pct:70.
 # If the image was downloaded at its maximum size, the ratio is 1.0
 - Set the -i option to enable downloading high-resolution thumbnails via the IIIF Gallica API.
+- Set the -w option to choose the number of images processed in parallel (default: number of CPUs).
+- Set the -r option to reduce the size of the annotated images (e.g. -r 2 for half size), which are then faster to produce.
 
 Example command:
 >python extract_box.py test 0.7 -i
@@ -40,8 +43,11 @@ Error Handling:
 - Tracks and reports missing image files and IIIF API errors.
 """
 
-import json
 import os
+import functools
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageDraw
 import argparse
 import requests
@@ -56,8 +62,7 @@ import utils
 model = "snooptypo/2"
 
 # IIIF
-iiif_error = 0
-iiif_ok = 0
+iiif_stats = utils.IIIFStats()
 
 # Folders
 output_dir = 'output' # general output folder
@@ -71,17 +76,18 @@ ark_dict = {}
 
 # the list of titles with no ARK found in the database
 arks_errors_file = os.path.join(output_dir,"arks_errors.txt")
+missing_arks = [] # written in the file at the end of the processing
 
 # the list of ARK identifiers found in the annotations
 processed_arks_file = os.path.join(output_dir,"processed_arks_list.csv")
 processed_arks = set()
 
-# Create a DataFrame to store processed data
-processed_data = pd.DataFrame(columns=utils.data_columns)
+# Rows of processed data (one dict per bounding box), written in a CSV file at the end
+processed_rows = []
 processed_data_file = os.path.join(output_dir,"processed_data.csv")
 
-# Create a dataframe for the Panoptic metadata import
-processed_data_pano = pd.DataFrame(columns=utils.data_columns_pano)
+# Rows for the Panoptic metadata import
+processed_rows_pano = []
 processed_data_file_pano = os.path.join(output_dir,"import_pano.csv")
 
 
@@ -95,8 +101,14 @@ parser.add_argument("data_dir", type=str, help="Path to the COCO folder")
 parser.add_argument('ratio',  type=float, default=1.0,
                     help='Image dimension ratio compared to the original image')
 parser.add_argument('-i', '--iiif', help='Download IIIF images of the annotated objects', action='store_true')
+parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                    help='Number of images processed in parallel (default: number of CPUs)')
+parser.add_argument('-r', '--reduce', type=int, default=1,
+                    help='Reduction factor of the annotated images (default: 1, full size)')
 
 args = parser.parse_args()
+workers = max(1, args.workers)
+overlay_reduce = max(1, args.reduce)
 ratio=args.ratio
 images_dir = args.data_dir
 coco_json_path = images_dir + "/_annotations.coco.json"
@@ -107,7 +119,12 @@ else:
     download = False
 
 
+# Special characters: everything but letters, digits and underscore (same as not isalnum() and not '_')
+special_chars_regex = re.compile(r'\W')
+
 # Clean the title string by removing spaces and special characters
+# (cached: the annotations of an image share the same filename)
+@functools.lru_cache(maxsize=None)
 def clean_title (title):
     
     # Remove everything after "_view" in the filename
@@ -115,10 +132,10 @@ def clean_title (title):
     # Replace spaces with underscores
     cleaned_string = title.replace(" ", "_")
     # Remove special characters
-    cleaned_string = ''.join(e for e in cleaned_string if e.isalnum() or e == '_')
+    cleaned_string = special_chars_regex.sub('', cleaned_string)
     # Convert accented characters to their standard form
     cleaned_string = unicodedata.normalize('NFD', cleaned_string)
-    cleaned_string = ''.join(c for c in cleaned_string if unicodedata.category(c) != 'Mn')
+    cleaned_string = cleaned_string.encode('ascii', 'ignore').decode('ascii')
     # Replace double underscores with a single underscore
     cleaned_string = cleaned_string.replace("__", "_")
     cleaned_string = cleaned_string[:30]
@@ -127,6 +144,19 @@ def clean_title (title):
         cleaned_string = cleaned_string[:-1]
     return cleaned_string.lower()
 
+# Vectorized version of clean_title, for a pandas Series of titles
+# (both functions must produce the same keys)
+def clean_titles(titles):
+
+    cleaned = titles.str.split('_view').str[0]
+    cleaned = cleaned.str.replace(" ", "_", regex=False)
+    cleaned = cleaned.str.replace(special_chars_regex, '', regex=True)
+    cleaned = cleaned.str.normalize('NFD').str.encode('ascii', 'ignore').str.decode('ascii')
+    cleaned = cleaned.str.replace("__", "_", regex=False)
+    cleaned = cleaned.str.slice(0, 30)
+    cleaned = cleaned.str.replace(r'_$', '', regex=True)
+    return cleaned.str.lower()
+
 # Function to find the ARK identifier in the data for a given image filename
 def find_ark(image_filename):
     request = clean_title(image_filename)
@@ -135,8 +165,7 @@ def find_ark(image_filename):
     if gallica_ark == "Unknown":
         print(f"# ARK not found for title {image_filename} #")
         # Add the title to an error list
-        with open(arks_errors_file, "a") as error_file:
-            error_file.write(f"{image_filename}\n")
+        missing_arks.append(image_filename)
         return -1
     else:
         # Add the ARK to a set for tracking processed ARKs
@@ -144,120 +173,177 @@ def find_ark(image_filename):
         return gallica_ark
 
 
-# Extract bounding boxes from COCO JSON and overlay them on images
-def extract_bounding_boxes(coco_json_path, images_dir, output_dir):
-    global image_not_found
-    global image_with_annot
-    global processed_data
-    global processed_data_pano
-    global iiif_error 
-    global iiif_ok
+# Save the image with its bounding boxes drawn
+def save_annotated_image(annotated_image, annotated_image_path):
+    annotated_image.save(annotated_image_path)
+    if utils.debug:
+        print(f"... processed and saved in: {annotated_image_path}")
 
-    # Load COCO dataset JSON file
-    with open(coco_json_path, 'r') as f:
-        coco_data = json.load(f) 
 
-    # Map image IDs to file names
-    image_id_to_file = {img['id']: img['file_name'] for img in coco_data['images']}
-    
-    # Process annotations
-    for annotation in coco_data['annotations']:   
-        image_id = annotation['image_id']
-        bb_id = annotation['id']
-        bbox = annotation['bbox']  # [x, y, width, height] / absolute coordinates
-        # Get the label class
-        category_id = annotation['category_id']
-        category_name = next((cat['name'] for cat in coco_data['categories'] if cat['id'] == category_id), "Unknown")
-           
-        # Get image file name
-        image_file = image_id_to_file.get(image_id)
-        if not image_file:
-            print("# Image ID {image_id} not found in COCO JSON, skipping... #")
-            continue
-        
-        # Load image
-        image_path = os.path.join(images_dir, image_file)
-        if not os.path.exists(image_path):
-            print(f"# Image file {image_path} not found, skipping... #")
-            image_not_found += 1
-            continue
-
-        # Copy the image to the output folder at the first annotation
-        out_image_filename = os.path.basename(image_path)
-        # Remove everything after "_jpg" in the filename
-        out_image_filename = out_image_filename.split('_jpg')[0] 
-        print(f"... processing image: {out_image_filename} ...")
-        copied_image_path = os.path.join(output_dir, out_image_filename + ".jpg")
-        if not os.path.exists(copied_image_path):
-            with open(image_path, 'rb') as src, open(copied_image_path, 'wb') as dst:
-                dst.write(src.read())
-                image_with_annot += 1
-
-        if out_image_filename.startswith('bpt') or out_image_filename.startswith('btv'):
-            gallica_ark = utils.get_ark_id(out_image_filename)
-            if utils.debug:
-                print(f"... found ARK in the database: {gallica_ark}")
-            # Extract the vue number from the filename 
-            vue = utils.get_vue(out_image_filename)     
-        else:
-            # find the related ark in the ARK database
-            gallica_ark = find_ark(out_image_filename)
-            if utils.debug:
-                print(f"... ARK: {gallica_ark}")
-            vue = utils.get_vue_trick(out_image_filename)
+# Process the annotations of one image (run in a worker thread):
+# draw the bounding boxes, extract the thumbnails and export the Supervision data.
+# Return the rows of processed data, the rows for Panoptic import, the IIIF downloads to do
+# and a status ("processed", "not_found" or "skipped")
+def process_image(image_file, annotations, category_id_to_name, images_dir, output_dir):
+    rows = []
+    rows_pano = []
+    iiif_tasks = []
 
-        ark_id = utils.get_ark_id(gallica_ark)
+    # Load image: the original image for thumbnail extraction
+    image_path = os.path.join(images_dir, image_file)
+    try:
+        origin_image = Image.open(image_path)
+    except FileNotFoundError:
+        print(f"# Image file {image_path} not found, skipping... #")
+        return rows, rows_pano, iiif_tasks, "not_found"
 
-        if vue is None:
-            print(f"# Warning! Cannot extract view number from filename {out_image_filename}, skipping... #")
-            continue
+    out_image_filename = os.path.basename(image_path)
+    # Remove everything after "_jpg" in the filename
+    out_image_filename = out_image_filename.split('_jpg')[0] 
+    print(f"... processing image: {out_image_filename} ...")
 
+    if out_image_filename.startswith('bpt') or out_image_filename.startswith('btv'):
+        gallica_ark = utils.get_ark_id(out_image_filename)
         if utils.debug:
-            print(f"... view number: {vue}")
+            print(f"... found ARK in the database: {gallica_ark}")
+        # Extract the vue number from the filename 
+        vue = utils.get_vue(out_image_filename)     
+    else:
+        # find the related ark in the ARK database
+        gallica_ark = find_ark(out_image_filename)
+        if gallica_ark == -1:
+            # the title is recorded in the ARK errors file
+            origin_image.close()
+            return rows, rows_pano, iiif_tasks, "skipped"
+        if utils.debug:
+            print(f"... ARK: {gallica_ark}")
+        vue = utils.get_vue_trick(out_image_filename)
 
-        # The annotated image
-        image = Image.open(copied_image_path)
-        draw = ImageDraw.Draw(image)
+    ark_id = utils.get_ark_id(gallica_ark)
 
-        # The original image for thumbnail extraction
-        origin_image = Image.open(image_path)
+    if vue is None:
+        print(f"# Warning! Cannot extract view number from filename {out_image_filename}, skipping... #")
+        origin_image.close()
+        return rows, rows_pano, iiif_tasks, "skipped"
+
+    if utils.debug:
+        print(f"... view number: {vue}")
+
+    # The annotated image (in the output folder), drawn on a copy of the decoded original
+    # or on a reduced version of it (the thumbnails are still extracted at full size)
+    if overlay_reduce > 1:
+        # Image.reduce does not support the palette and bilevel modes
+        if origin_image.mode in ("P", "1"):
+            annotated_image = origin_image.convert("RGB").reduce(overlay_reduce)
+        else:
+            annotated_image = origin_image.reduce(overlay_reduce)
+    else:
+        annotated_image = origin_image.copy()
+    draw = ImageDraw.Draw(annotated_image)
+    copied_image_path = os.path.join(output_dir, out_image_filename + ".jpg")
+
+    # Get the image width and height
+    image_dim = origin_image.size
+    w = image_dim[0]
+    h = image_dim[1]
+    #print (f"... image dimensions: {image_dim[0]}x{image_dim[1]} pixels")
+
+    # Process the annotations of the image
+    for annotation in annotations:
+        bb_id = annotation['id']
+        bbox = annotation['bbox']  # [x, y, width, height] / absolute coordinates
+        # Get the label class
+        category_id = annotation['category_id']
+        category_name = category_id_to_name.get(category_id, "Unknown")
 
         # Draw bounding box
         x, y, width, height = bbox
-        utils.draw_bbox(x, y, width, height, draw, category_name)
-
-        # Save image with bounding box drawn
-        image.save(copied_image_path)
-        if utils.debug:
-            print(f"... processed and saved in: {copied_image_path}")       
+        utils.draw_bbox(x/overlay_reduce, y/overlay_reduce, width/overlay_reduce, height/overlay_reduce, draw, category_name, overlay_reduce)
 
-        # Get the image width and height
-        image_dim = origin_image.size
-        w = image_dim[0]
-        h = image_dim[1]
-        #print (f"... image dimensions: {image_dim[0]}x{image_dim[1]} pixels")
         # Generate the IIIF thumbnail URL
         gallica_iiif_url = utils.build_iiif_full_size(ark_id, vue, x, y, width, height, w,h, utils.iiif_size) 
         # Generate output filename for the bounding box thumbnail
         out_file = utils.format_bb_filename(out_image_filename, category_name, bb_id)
-        # Add data to the DataFrame for processed data
-        processed_data = utils.add_output_data(processed_data, gallica_ark, vue, image_file, out_file, category_name, gallica_iiif_url, 1.0)
-        # Add data to the DataFrame for Panoptic import
-        processed_data_pano = utils.add_output_pano_data(processed_data_pano, gallica_ark, vue, out_file, category_name, gallica_iiif_url)
-        # export the data as a Supervision format
-        utils.exportSV(sv_dir, image_file, category_id, category_name, x, y, w, h, vue, gallica_ark, model, ratio)
+        # Add data to the rows of processed data
+        utils.add_output_data(rows, gallica_ark, vue, image_file, out_file, category_name, gallica_iiif_url, 1.0, ark_id)
+        # Add data to the rows for Panoptic import
+        utils.add_output_pano_data(rows_pano, gallica_ark, vue, out_file, category_name, gallica_iiif_url)
+        # export the data as a Supervision format (written at the end)
+        utils.exportSV(image_file, category_id, category_name, x, y, w, h, vue, gallica_ark, model, ratio)
 
         # Extract thumbnail from the image file for the bounding box and save it    
         if gallica_ark:
             thumbnail = origin_image.crop((x, y, x + width, y + height))
             utils.export_thumbnail(thumbnail, thumbs_dir, gallica_ark, out_file, category_name)
 
-        # Extract full-resolution thumbnail using Gallica IIIF Image API        
+        # Extract full-resolution thumbnail using Gallica IIIF Image API (downloaded at the end)
         if download and gallica_ark:
             iiif_out_file = utils.format_bb_filename(utils.format_base_filename(ark_id,vue), category_name, bb_id)
-            iiif_error, iiif_ok = utils.export_thumbnail_iiif(gallica_iiif_url, iiif_thumbs_dir, gallica_ark, iiif_out_file)    
+            iiif_tasks.append((gallica_iiif_url, iiif_thumbs_dir, gallica_ark, iiif_out_file))
+
+    # Save the image with all its bounding boxes drawn
+    save_annotated_image(annotated_image, copied_image_path)
+    return rows, rows_pano, iiif_tasks, "processed"
+
+
+# Extract bounding boxes from COCO JSON and overlay them on images
+def extract_bounding_boxes(coco_json_path, images_dir, output_dir):
+    global image_not_found
+    global image_with_annot
+    global iiif_stats
+
+    # Load COCO dataset JSON file
+    coco_data = utils.load_json_file(coco_json_path)
+
+    # Map image IDs to file names
+    image_id_to_file = {img['id']: img['file_name'] for img in coco_data['images']}
+    # Map category IDs to names
+    category_id_to_name = {cat['id']: cat['name'] for cat in coco_data['categories']}
+    
+    # Group the annotations by image: each image is set up and decoded once for all its bounding boxes
+    annotations_by_image = defaultdict(list)
+    for annotation in coco_data['annotations']:
+        annotations_by_image[annotation['image_id']].append(annotation)
+
+    # IIIF thumbnails to download
+    iiif_tasks = []
+
+    try:
+        # Process images in parallel (Pillow releases the GIL while decoding, cropping and encoding)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for image_id, annotations in annotations_by_image.items():
+                # Get image file name
+                image_file = image_id_to_file.get(image_id)
+                if not image_file:
+                    print(f"# Image ID {image_id} not found in COCO JSON, skipping... #")
+                    continue
+                futures.append(executor.submit(process_image, image_file, annotations, category_id_to_name, images_dir, output_dir))
+
+            # the results are gathered in the images order
+            for future in futures:
+                rows, rows_pano, image_iiif_tasks, status = future.result()
+                processed_rows.extend(rows)
+                processed_rows_pano.extend(rows_pano)
+                iiif_tasks.extend(image_iiif_tasks)
+                if status == "not_found":
+                    image_not_found += 1
+                elif status == "processed":
+                    image_with_annot += 1
+    finally:
+        # Write the titles with no ARK found, even if the processing aborted
+        if missing_arks:
+            with open(arks_errors_file, "a") as error_file:
+                error_file.write("".join(f"{title}\n" for title in missing_arks))
     # end of the loop
 
+    # Write the Supervision data: one file per view
+    utils.flush_sv(sv_dir)
+
+    # Download the IIIF thumbnails in parallel
+    if iiif_tasks:
+        iiif_stats = utils.download_many(iiif_tasks)
+
     print(f"\nNumber of annotations in the dataset: {len(coco_data['annotations'])}")
     print(f"Number of images in the dataset: {len(coco_data['images'])}")
     print(f"Number of images with annotations: {image_with_annot}")
@@ -279,10 +365,12 @@ if not os.path.exists(arks_data_file):
     exit(1)
 
 # Load ARKs database (title/ark) 
-with open(arks_data_file, 'r') as csvfile:
-    reader = csv.reader(csvfile, delimiter="#")
-    for row in reader:
-        ark_dict[clean_title(row[0])] = row[1]  # Create a dictionary with ark as key and the first 20 characters of title as value
+# rows with more than 2 fields keep their first two fields (title, ark), rows with no ARK are dropped
+arks_data = pd.read_csv(arks_data_file, sep="#", header=None, names=["title", "ark"], dtype=str,
+                        keep_default_na=False, engine="python", on_bad_lines=lambda fields: fields[:2])
+arks_data = arks_data[arks_data["ark"].fillna("") != ""]
+# Create a dictionary with the cleaned title as key and the ark as value
+ark_dict = dict(zip(clean_titles(arks_data["title"]), arks_data["ark"]))
 
 print(f"--------------------------------\nLength of ARKS dictionary: {len(ark_dict)}")
 #print(ark_dict)
@@ -311,11 +399,8 @@ with open(processed_arks_file, "a", newline="") as csvfile:
 print(f"\nProcessed ARKs saved to: {processed_arks_file}")
 
 # Save the processed data to a CSV files
-processed_data.to_csv(processed_data_file, index=False)
-processed_data_pano.to_csv(processed_data_file_pano, index=False, sep=";") 
-
-# fix the Supervision JSON files
-utils.fixSV(sv_dir)
+utils.write_csv(processed_data_file, processed_rows, utils.data_columns)
+utils.write_csv(processed_data_file_pano, processed_rows_pano, utils.data_columns_pano, delimiter=";")
 
 print("----------------------------------------")
 print(f"Processed data saved to: {processed_data_file}")
@@ -323,7 +408,7 @@ print(f"Import data for Panoptic saved to: {processed_data_file_pano}")
 print(f"Supervision data saved to: {sv_dir}")
 print("Thumbnails saved in: ", thumbs_dir)
 if args.iiif:
-    print(f"IIIF thumbnails downloaded: {iiif_ok} in {iiif_thumbs_dir}")
-    if iiif_error != 0:
-        print(f"## Warning! IIIF errors: {iiif_error} ##")
+    print(f"IIIF thumbnails downloaded: {iiif_stats.ok} in {iiif_thumbs_dir}")
+    if iiif_stats.error != 0:
+        print(f"## Warning! IIIF errors: {iiif_stats.error} ##")
 print("----------------------------------------")
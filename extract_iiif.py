@@ -5,8 +5,9 @@ and export all images of these documents thanks to the Gallica IIIF Image API
 Usage:
 1. Provide the path to the ARKs file as a command-line argument.
 2. Specify the image dimension ratio (between 0 and 1.0) to control the size of the downloaded images.
+3. Optionally set the number of parallel downloads with -w (default: 16).
 Example command:
->python extract.py arks.txt 0.7
+>python extract.py arks.txt 0.7 -w 8
 
 Output:
 - Thumbnails organized by ARK ("output/ARK" folder) 
@@ -16,6 +17,7 @@ Error Handling:
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageDraw
 import argparse
 import requests
@@ -27,8 +29,10 @@ output_dir = 'IIIF_images'
 
 # IIIF
 iiif_size = "max"
-iiif_error = 0
-iiif_ok = 0
+iiif_stats = utils.IIIFStats()
+
+# Pagination API: a few lookups in parallel are enough to keep the IIIF downloads busy
+pagination_workers = 4
 
 # Other counters
 arks = 0
@@ -39,7 +43,12 @@ parser = argparse.ArgumentParser(description="Extract images thanks to the IIIF
 parser.add_argument("arks_file", type=str, help="Path to the ARKs file")
 parser.add_argument('ratio',  type=float, default=0.7,
                     help='image dimension ratio')
+parser.add_argument('-w', '--workers', type=int, default=16,
+                    help='number of parallel IIIF downloads')
 args = parser.parse_args()
+workers = max(1, args.workers)
+# one pooled HTTP connection per worker (Pagination and IIIF workers run at the same time)
+utils.set_http_pool_size(workers + pagination_workers)
 
 arks_file = args.arks_file
 ratio = args.ratio
@@ -70,26 +79,35 @@ if not os.path.exists(arks_file):
     print(f"# ARKs file {arks_file} not found! #")
     exit(1)
 
+# Number of images of the ARKs already seen in previous runs
+utils.load_pagination_cache()
+
 # Load ARKs list 
 with open(arks_file, 'r') as txtfile:
-    for line in txtfile:
-        ark = line.strip()  
-        if ark:
-            arks += 1
-            n = utils.get_number_of_images(ark)
-            if n == 0:
-                image_not_found += 1
-            else:
-                print(f"--------------------\nProcessing ARK: {ark} with {n} images")
-                ark_id = utils.get_ark_id(ark) # remove "ark:/12148/"
-                for i in range(1, n+1):
-                    url = utils.build_iiif_url(ark_id, i, iiif_size)                
-                    output_filename = utils.format_filename(ark_id, i, "jpg")
-                    iiif_error, iiif_ok = utils.export_thumbnail_iiif(url, output_dir, ark, output_filename)
+    ark_list = [line.strip() for line in txtfile if line.strip()]
+arks = len(ark_list)
+
+# the numbers of images of the documents are requested in parallel
+# and the images of a document are downloaded as soon as its number of images is known
+futures = {}
+with ThreadPoolExecutor(max_workers=pagination_workers) as pagination_executor, ThreadPoolExecutor(max_workers=workers) as iiif_executor:
+    for ark, n in zip(ark_list, pagination_executor.map(utils.get_number_of_images, ark_list)):
+        if n == 0:
+            image_not_found += 1
+        else:
+            print(f"--------------------\nProcessing ARK: {ark} with {n} images")
+            ark_id = utils.get_ark_id(ark) # remove "ark:/12148/"
+            for i in range(1, n+1):
+                url = utils.build_iiif_url(ark_id, i, iiif_size)
+                output_filename = utils.format_filename(ark_id, i, "jpg")
+                task = (url, output_dir, ark, output_filename)
+                futures[iiif_executor.submit(utils.export_thumbnail_iiif, *task)] = task
+    utils.save_pagination_cache()
+    iiif_stats = utils.sum_downloads(futures)
 
 print(f"--------------------------------\nARKs processed: {arks}")
 print(f"ARKs not processed because of Pagination API errors: {image_not_found}")
 print("----------------------------------------")
-print(f"IIIF images downloaded: {iiif_ok}")
-if iiif_error != 0:
-    print(f"## Warning! IIIF errors: {iiif_error} ##")
+print(f"IIIF images downloaded: {iiif_stats.ok}")
+if iiif_stats.error != 0:
+    print(f"## Warning! IIIF errors: {iiif_stats.error} ##")
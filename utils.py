@@ -1,29 +1,99 @@
 #
 
 import os
+import atexit
+import shutil
+import functools
+from collections import defaultdict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-from PIL import Image, ImageFont
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import ImageFont
 import json
-import pandas as pd
+import csv
+# orjson is optional: it parses large JSON files (e.g. COCO annotations) and serializes the Supervision data faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+# lxml is optional: it parses the XML of the Gallica Pagination API faster
+try:
+    from lxml import etree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
 
 # global variables
 debug = True
 iiif_size = "max" #  we want the thumbnails at the maximum size
-iiif_error = 0
-iiif_ok = 0
-image_not_found = 0
 
 # IIIF
 #gallica_base_url = "https://gallica.bnf.fr/iiif/ark:/12148/"
 gallica_base_url = "https://openapi.bnf.fr/iiif/image/v3/ark:/12148/" # v3 version
 iiif_log_file = "iiif_errors.log"
 
+# HTTP session shared by all the calls to the Gallica APIs (and by the download threads)
+# keep-alive connections are reused instead of opening a new TCP+TLS connection per request
+http_timeout = 60 # seconds
+http_session = requests.Session()
+http_pool_size = 0
+
+# Size the connection pool of the session for the given number of threads (the pool only grows):
+# with more threads than pooled connections, the extra connections would be closed after each request
+def set_http_pool_size(size):
+    global http_pool_size
+    if size > http_pool_size:
+        http_pool_size = size
+        http_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=size,
+                                                   max_retries=Retry(total=3, backoff_factor=0.3)))
+
+set_http_pool_size(32)
+http_session.headers.update({"User-Agent": "altomator-Roboflow (https://github.com/altomator/Roboflow)"})
+
 ### Helper functions ###
 def mkdir(name):
     if not os.path.isdir(name):
         print("...creating folder: ", name)
         os.mkdir(name)
 
+# Create a directory (and its parents) if needed, only once per process
+# the thumbnails of a document all go in the same directories
+ensured_dirs = set()
+def ensure_dir(path):
+    if path not in ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        ensured_dirs.add(path)
+
+# Names of the files of the directories already scanned, so that the existing
+# images are skipped without a stat per image (see export_thumbnail_iiif)
+dir_index = {}
+def existing_files(path):
+    files = dir_index.get(path)
+    if files is None:
+        try:
+            files = {entry.name for entry in os.scandir(path)}
+        except FileNotFoundError:
+            files = set()
+        dir_index[path] = files
+    return files
+
+# Load a JSON file, with orjson if it is installed
+def load_json_file(path):
+    with open(path, 'rb') as f:
+        if orjson is not None:
+            return orjson.loads(f.read())
+        return json.load(f)
+
+# Write data in a JSON file, with orjson if it is installed
+def dump_json_file(path, data):
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
 # Remove "ark:/12148/" from ARK identifier
 def get_ark_id(id):
     if id.startswith("ark:"):
@@ -34,19 +104,20 @@ def get_ark_id(id):
 def get_ark(ark):
     return ("ark:/12148/"+ark)
 
-# Format the filename based on ARK, view number, and type."""
-def format_filename(ark, vue, type):  
-    if type(vue) is str:
+# Format the filename based on ARK, view number, and extension
+# (don't name a parameter "type": it would shadow the builtin used to check the view number)
+def format_filename(ark, vue, ext):  
+    if isinstance(vue, str):
         try:
             vue = int(vue)
         except ValueError:
             return None
     # Pad view number with leading zeros to 4 digits
-    return f"{ark}-{vue:04d}.{type}"
+    return f"{ark}-{vue:04d}.{ext}"
 
-# Format the filename based on ARK, view number, and type."""
+# Format the base filename (no extension) based on ARK and view number
 def format_base_filename(ark, vue):  
-    if type(vue) is str:
+    if isinstance(vue, str):
         try:
             vue = int(vue) 
         except ValueError:
@@ -85,24 +156,33 @@ def get_image_size(image):
     """Return the width and height of a PIL image"""
     return image.size  # (width, height)
 
+# Colors of the classes
+class_colors = {
+    "Vignette": "#0492C2",
+    "Lettrine": "#ff69B4",
+    "Ornement": "#8601AF"
+}
+
 def get_color_by_class(class_name):
     """Return a color based on the class name."""
 
-    return   {
-            "Vignette": "#0492C2",
-            "Lettrine": "#ff69B4",
-            "Ornement": "#8601AF"
-        }.get(class_name, "red")  # Default
+    return class_colors.get(class_name, "red")  # Default
+
+# Load the label font once: parsing the TTF file is costly
+@functools.lru_cache(maxsize=4)
+def get_font(size):
+    return ImageFont.truetype("Arial Unicode.ttf", size)
 
 # Draw bounding box and label on a PIL image
-def draw_bbox(x,y,width,height, draw, category_name):
+# reduce is the reduction factor of the image: the outline and the label are scaled down with it
+def draw_bbox(x,y,width,height, draw, category_name, reduce=1):
 
     color=get_color_by_class(category_name)
     # Draw bounding box
-    draw.rectangle([x, y, x + width, y + height], outline=color, width=4)
+    draw.rectangle([x, y, x + width, y + height], outline=color, width=max(1, round(4/reduce)))
     # Draw label class
-    text_position = (x + 2, y - 5)  # Position above the bounding box
-    font = ImageFont.truetype("Arial Unicode.ttf", 30)
+    text_position = (x + 2/reduce, y - 5/reduce)  # Position above the bounding box
+    font = get_font(max(1, round(30/reduce)))
     draw.text(text_position, category_name, fill=color, font=font)
     return draw
 
@@ -113,7 +193,7 @@ def export_thumbnail(thumbnail, thumbs_dir, ark, filename, category_name):
     ark = get_ark_id(ark)
     # Create a directory for the category if it doesn't exist
     category_dir = os.path.join(thumbs_dir, ark, category_name)
-    os.makedirs(category_dir, exist_ok=True)
+    ensure_dir(category_dir)
     # Save the thumbnail
     thumbnail_path = os.path.join(category_dir, filename)
     thumbnail.save(thumbnail_path)
@@ -128,100 +208,136 @@ def build_iiif_url(ark, vue, iiif_size):
 
 # Extract and save a IIIF image to the specified directory
 # url is the IIIF image URL
+# Return (error, ok) for this image: (1, 0) if the download failed, (0, 1) if it succeeded, (0, 0) if the image already exists
 def export_thumbnail_iiif(url, thumbs_dir, ark, filename):
-    global iiif_error 
-    global iiif_ok
 
     ark = get_ark_id(ark)
     # Create a directory for the category if it doesn't exist
     # category_dir = os.path.join(thumbs_dir, ark, category_name)
     # we don't use category
     category_dir = os.path.join(thumbs_dir, ark)
-    os.makedirs(category_dir, exist_ok=True)
+    ensure_dir(category_dir)
     thumbnail_path = os.path.join(category_dir, filename)
-    if os.path.exists(thumbnail_path):
+    part_path = thumbnail_path + ".part"
+    if filename in existing_files(category_dir):
         print(f"... IIIF image already exists: {thumbnail_path}")
-        return iiif_error, iiif_ok
+        return 0, 0
     try:
         print(f"... downloading image with the IIIF API: {url} ...")
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        if response.status_code == 200:
-            iiif_thumbnail = Image.open(response.raw)
-            iiif_thumbnail.save(thumbnail_path)
-            if debug:
-                print(f"... IIIF image saved in: {thumbnail_path}")   
-            iiif_ok += 1   
-        else:
-            print(f"# Failed to download IIIF image: {response.status_code} #")
-            iiif_error += 1
+        with http_session.get(url, stream=True, timeout=http_timeout) as response:
+            response.raise_for_status()
+            if response.status_code == 200:
+                # the server returns a JPEG: stream it to disk as is, without decoding it
+                # (to a temporary file, so that an interrupted download is not taken for an existing image)
+                with open(part_path, "wb") as f:
+                    shutil.copyfileobj(response.raw, f, length=64*1024)
+                os.replace(part_path, thumbnail_path)
+                existing_files(category_dir).add(filename)
+                if debug:
+                    print(f"... IIIF image saved in: {thumbnail_path}")   
+                return 0, 1
+            else:
+                print(f"# Failed to download IIIF image: {response.status_code} #")
+                return 1, 0
     except Exception as e:
         print(f"# Failed to download IIIF image: {e} #")
-        iiif_error += 1
+        # remove the partial download, if any
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+        return 1, 0
+
+# Counters of the IIIF downloads
+@dataclass
+class IIIFStats:
+    ok: int = 0
+    error: int = 0
+
+# Sum the outcomes of IIIF download futures
+# futures is a dict {future: (url, thumbs_dir, ark, filename)}, see export_thumbnail_iiif
+# Return the IIIFStats of the downloads: the outcomes of the threads are summed here, no counter is shared
+def sum_downloads(futures, log_errors=False):
+    stats = IIIFStats()
+    for done, future in enumerate(as_completed(futures), 1):
+        error, ok = future.result()
+        stats.error += error
+        stats.ok += ok
+        if error and log_errors:
+            # add a line in a log file
+            log_iiif_error(futures[future][0])
+        if debug:
+            print(f"... IIIF downloads: {done}/{len(futures)}")
+    return stats
 
-    return iiif_error, iiif_ok
+# Download IIIF images in parallel (the threads share the HTTP session)
+# tasks is a list of (url, thumbs_dir, ark, filename) tuples, see export_thumbnail_iiif
+def download_many(tasks, workers=16, log_errors=False):
+    set_http_pool_size(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(export_thumbnail_iiif, *task): task for task in tasks}
+        return sum_downloads(futures, log_errors)
 
 # Build the IIIF URL for a given bounding box
 # iiif_size is the output size we want for the thumbnail
 def build_iiif_full_size(gallica_ark, vue, x, y, width, height, w, h, iiif_size):
         
-        # we express IIIF bbox as % compared to the full image size
-        x_per = str(round(x/w*100, 2))
-        y_per = str(round(y/h*100, 2))
-        w_per = str(round(width/w*100, 2))
-        h_per = str(round(height/h*100, 2))
-        pct = f"pct:{x_per},{y_per},{w_per},{h_per}"
-        return f"{gallica_base_url}{gallica_ark}/f{vue}/{pct}/{iiif_size}/0/default.jpg" 
+        # we express IIIF bbox as % compared to the full image size (2 decimals)
+        rw = 100.0 / w
+        rh = 100.0 / h
+        return f"{gallica_base_url}{gallica_ark}/f{vue}/pct:{x*rw:.2f},{y*rh:.2f},{width*rw:.2f},{height*rh:.2f}/{iiif_size}/0/default.jpg" 
 
 
+# the log file is opened at the first error and kept open (buffered writes) until the end of the process
+iiif_log = None
 def log_iiif_error(gallica_iiif_url):  
-    with open(iiif_log_file, "a") as log_file:
-        log_file.write(gallica_iiif_url + "\n")
-        if debug:
-            print(f"... logged IIIF error for URL: {gallica_iiif_url}")
+    global iiif_log
+
+    if iiif_log is None:
+        iiif_log = open(iiif_log_file, "a", buffering=1 << 16)
+        atexit.register(iiif_log.close)
+    iiif_log.write(gallica_iiif_url + "\n")
+    if debug:
+        print(f"... logged IIIF error for URL: {gallica_iiif_url}")
 
 ### Supervision data ###
 
-# Export the bounding box in supervision format in a path named after this scheme: sv_dir/ark/ark-vue.json  
-def  exportSV(sv_dir, image_file, category_id, category_name, x, y, w, h, vue, ark, model, ratio):
+# Bounding boxes in supervision format, buffered per view (ark, vue) until they are written by flush_sv
+sv_buffer = defaultdict(list)
+
+# Add the bounding box in supervision format to the buffer of its view
+def exportSV(image_file, category_id, category_name, x, y, w, h, vue, ark, model, ratio):
 
     # Extract the last part of the ARK identifier
     ark = get_ark_id(ark)
     # fill the view number with leading zeros to 4 digits
     vue = str(vue).zfill(4)
-    os.makedirs(os.path.join(sv_dir, ark), exist_ok=True)
-    sv_file = os.path.join(sv_dir, ark, ark + "-" + vue + ".json")
-    print(f"... exporting supervision data in: {sv_file}")
-    # If the file does not exist, create it and write the header
-    if not os.path.exists(sv_file): 
-        with open(sv_file, "w") as f:
-            f.write(f"[\n")
-        with open(sv_file, "a") as f:
-            json_record = {
-                "x_min": x,
-                "y_min": y,
-                "x_max": x + w,
-                "y_max": y + h,
-                "class_id": category_id,
-                "confidence": "1.0", 
-                "tracker_id": "",
-                "class_name": category_name,
-                "file": image_file,
-                "model": model,
-                "_comment": f"Supervision format for ARK: {ark}, vue: {vue}; x,y,w,h in pixels, relatively to the listed file ({ratio} ratio with the original image)"
-            }
-            f.write(json.dumps(json_record) + ",")
-    if debug:
-        print(f"... supervision format saved in: {sv_file}")
-
-# replace the last comma in the JSON supervision files with a closing bracket
-def fixSV(sv_dir): 
-
-    json_files = [os.path.join(dp, f) for dp, dn, filenames in os.walk(sv_dir) for f in filenames if os.path.splitext(f)[1] == '.json']
-    for sv_path in json_files:
-        os.system(f"sed 's/,$/]/' {sv_path} > tmp.json")
-        os.system(f"mv tmp.json  {sv_path}")
-
+    sv_buffer[(ark, vue)].append({
+        "x_min": x,
+        "y_min": y,
+        "x_max": x + w,
+        "y_max": y + h,
+        "class_id": category_id,
+        "confidence": "1.0", 
+        "tracker_id": "",
+        "class_name": category_name,
+        "file": image_file,
+        "model": model,
+        "_comment": f"Supervision format for ARK: {ark}, vue: {vue}; x,y,w,h in pixels, relatively to the listed file ({ratio} ratio with the original image)"
+    })
+
+# Write the buffered bounding boxes in supervision format, one JSON array per view,
+# in a path named after this scheme: sv_dir/ark/ark-vue.json  
+def flush_sv(sv_dir):
+
+    for (ark, vue), records in sv_buffer.items():
+        ensure_dir(os.path.join(sv_dir, ark))
+        sv_file = os.path.join(sv_dir, ark, ark + "-" + vue + ".json")
+        print(f"... exporting supervision data in: {sv_file}")
+        dump_json_file(sv_file, records)
+        if debug:
+            print(f"... supervision format saved in: {sv_file}")
+    sv_buffer.clear()
 
 
 ### CSV data generation ###
@@ -229,61 +345,95 @@ def fixSV(sv_dir):
 data_columns = ["ARK", "Vue", "Image_filename", "Annotation_filename", "Category_name", "Gallica", "IIIF", "Confidence"]
 data_columns_pano = ["path", "Gallica[url]", "IIIF[url]", "Classe[tag]", "ARK[text]"]
 
-# Add data to the DataFrame
-def add_output_data(processed_data, ark, vue, image_file, out_file, category_name, gallica_iiif_url, confidence):
-    
-    return pd.concat([processed_data, pd.DataFrame([{
+# Add a row of data to the list of processed rows (one dict per bounding box)
+# The CSV file is written once from the rows list, when all the data has been processed (see write_csv)
+# ark_id (ark without "ark:/12148/") can be given by the caller when it is already known
+def add_output_data(processed_rows, ark, vue, image_file, out_file, category_name, gallica_iiif_url, confidence, ark_id=None):
+
+    if ark_id is None:
+        ark_id = get_ark_id(ark)
+    processed_rows.append({
             "ARK": ark,
             "Vue": vue,
             "Image_filename": image_file,
-            "Annotation_filename": f"{get_ark_id(ark)}/{out_file}",
+            "Annotation_filename": f"{ark_id}/{out_file}",
             "Category_name": category_name,
             "Gallica": f"https://gallica.bnf.fr/{ark}/f{vue}.item",
             "IIIF": gallica_iiif_url,
             "Confidence": confidence
-        }])], ignore_index=True)
+        })
 
 
-def add_output_pano_data(processed_data_pano, ark, vue, out_file, category_name, gallica_iiif_url):
+def add_output_pano_data(processed_rows_pano, ark, vue, out_file, category_name, gallica_iiif_url):
 
-    return pd.concat([processed_data_pano, pd.DataFrame([{
+    processed_rows_pano.append({
             "path": out_file,
             "Gallica[url]": f"https://gallica.bnf.fr/{ark}/f{vue}.item",
             "IIIF[url]": gallica_iiif_url,
             "Classe[tag]": category_name,
             "ARK[text]": ark
-        }])], ignore_index=True)
+        })
+
+
+# Write the rows (list of dicts) in a CSV file with the given columns
+def write_csv(csv_file, rows, columns, delimiter=","):
+    with open(csv_file, "w", newline="", encoding="utf-8") as f:
+        # same encoding and line endings as the former DataFrame.to_csv (UTF-8, os.linesep), DictWriter defaults to \r\n
+        writer = csv.DictWriter(f, fieldnames=columns, delimiter=delimiter, lineterminator=os.linesep)
+        writer.writeheader()
+        writer.writerows(rows)
 
 
 ### Gallica  APIs ###
 
+# Cache of the number of images per ARK id, persisted between runs
+# (only successful answers of the Pagination API are cached, so that failed ARKs are retried)
+pagination_cache_file = "iiif_pagination_cache.json"
+pagination_cache = {}
+
+def load_pagination_cache(cache_file=pagination_cache_file):
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r") as f:
+                pagination_cache.update(json.load(f))
+        except ValueError:
+            # corrupted cache: start with an empty one
+            print(f"# Warning: invalid pagination cache {cache_file}, ignored #")
+            return
+        if debug:
+            print(f"... {len(pagination_cache)} ARK(s) loaded from the pagination cache: {cache_file}")
+
+def save_pagination_cache(cache_file=pagination_cache_file):
+    # written to a temporary file first, so that an interrupted run does not leave a truncated cache
+    tmp_file = cache_file + ".part"
+    with open(tmp_file, "w") as f:
+        json.dump(pagination_cache, f)
+    os.replace(tmp_file, cache_file)
+
 # Get the number of images of a Gallica document thanks to its ARK and the Gallica Pagination API: https://gallica.bnf.fr/services/Pagination
 # This API returns an XML flow with the <nbVueImages> element indicating the number of images
 def get_number_of_images(ark):
-    global image_not_found
-
     # Remove "ark:/12148/" from ARK identifier
     ark = get_ark_id(ark)
+    if ark in pagination_cache:
+        return pagination_cache[ark]
     pagination_url = f"https://gallica.bnf.fr/services/Pagination?ark={ark}&format=xml"
     try:
-        response = requests.get(pagination_url)
+        response = http_session.get(pagination_url, timeout=http_timeout)
         response.raise_for_status()
         if response.status_code == 200:
             # Parse the XML to find the <nbVueImages> element
-            from xml.etree import ElementTree as ET
             root = ET.fromstring(response.content)
             nb_images_elem = root.find('.//nbVueImages')
             if nb_images_elem is not None and nb_images_elem.text.isdigit():
-                return int(nb_images_elem.text)
+                pagination_cache[ark] = int(nb_images_elem.text)
+                return pagination_cache[ark]
             else:
                 print(f"# Warning: <nbVueImages> element not found or invalid in the pagination response for ARK {ark} #")
-                image_not_found += 1
                 return 0
         else:
             print(f"# Failed to retrieve pagination info for ARK {ark}:\n{response.status_code}")
-            image_not_found += 1
             return 0
     except Exception as e:
         print(f"# Failed to retrieve pagination info for ARK {ark}:\n{e}")
-        image_not_found += 1
         return 0
\ No newline at end of file